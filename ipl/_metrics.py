@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+#
+# similarity metrics evaluated on numpy volumes
+#
+# used by the CLI drivers for cheap convergence / QC checks without
+# shelling out to minctracc again; kernels are JIT-compiled with numba
+# when it is available, otherwise plain numpy does the reductions
+
+import math
+
+import numpy as np
+
+try:
+    from numba import njit, prange
+    have_numba=True
+except ImportError:
+    # numba not available, fall back to numpy implementation
+    have_numba=False
+
+
+if have_numba:
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _xcorr_kernel(a, b, m):
+        sxy = 0.0
+        sxx = 0.0
+        syy = 0.0
+        use_mask = m.size == a.size
+        for i in prange(a.size):
+            if use_mask and m[i] == 0:
+                continue
+            x = a[i]
+            y = b[i]
+            sxy += x*y
+            sxx += x*x
+            syy += y*y
+        return sxy, sxx, syy
+
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _xcorr_ssd_kernel(a, b, m):
+        sxy = 0.0
+        sxx = 0.0
+        syy = 0.0
+        sdd = 0.0
+        n = 0
+        use_mask = m.size == a.size
+        for i in prange(a.size):
+            if use_mask and m[i] == 0:
+                continue
+            x = a[i]
+            y = b[i]
+            d = x-y
+            sxy += x*y
+            sxx += x*x
+            syy += y*y
+            sdd += d*d
+            n += 1
+        return sxy, sxx, syy, sdd, n
+
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _ssd_kernel(a, b, m):
+        s = 0.0
+        n = 0
+        use_mask = m.size == a.size
+        for i in prange(a.size):
+            if use_mask and m[i] == 0:
+                continue
+            d = a[i]-b[i]
+            s += d*d
+            n += 1
+        return s, n
+
+
+def _flat(vol):
+    return np.ascontiguousarray(vol, dtype=np.float64).ravel()
+
+
+def _flat_mask(mask):
+    if mask is None:
+        return np.zeros(0, dtype=np.uint8)
+    return np.ascontiguousarray(mask, dtype=np.uint8).ravel()
+
+
+def xcorr(a, b, mask=None):
+    """normalized cross-correlation between two volumes
+
+    Arguments:
+    a, b -- numpy arrays of identical shape
+    mask -- (optional) byte/bool array, voxels outside are ignored
+    """
+    a = _flat(a)
+    b = _flat(b)
+    if have_numba:
+        sxy, sxx, syy = _xcorr_kernel(a, b, _flat_mask(mask))
+    else:
+        if mask is not None:
+            sel = np.asarray(mask).ravel() > 0
+            a = a[sel]
+            b = b[sel]
+        sxy = float(np.dot(a, b))
+        sxx = float(np.dot(a, a))
+        syy = float(np.dot(b, b))
+    if sxx <= 0.0 or syy <= 0.0:
+        return 0.0
+    return sxy/math.sqrt(sxx*syy)
+
+
+def ssd(a, b, mask=None):
+    """mean squared difference between two volumes
+
+    Arguments:
+    a, b -- numpy arrays of identical shape
+    mask -- (optional) byte/bool array, voxels outside are ignored
+    """
+    a = _flat(a)
+    b = _flat(b)
+    if have_numba:
+        s, n = _ssd_kernel(a, b, _flat_mask(mask))
+    else:
+        if mask is not None:
+            sel = np.asarray(mask).ravel() > 0
+            a = a[sel]
+            b = b[sel]
+        d = a-b
+        s = float(np.dot(d, d))
+        n = d.size
+    if n == 0:
+        return 0.0
+    return s/n
+
+def xcorr_ssd(a, b, mask=None):
+    """normalized cross-correlation and mean squared difference, fused
+
+    One sweep over both volumes instead of two: the accumulators for
+    the correlation and the difference share the same loads, which
+    matters because these reductions are memory bound.
+    """
+    a = _flat(a)
+    b = _flat(b)
+    if have_numba:
+        sxy, sxx, syy, sdd, n = _xcorr_ssd_kernel(a, b, _flat_mask(mask))
+    else:
+        if mask is not None:
+            sel = np.asarray(mask).ravel() > 0
+            a = a[sel]
+            b = b[sel]
+        sxy = float(np.dot(a, b))
+        sxx = float(np.dot(a, a))
+        syy = float(np.dot(b, b))
+        # reuse the three dot products instead of a fourth pass
+        sdd = sxx-2.0*sxy+syy
+        n = a.size
+    _xcorr = 0.0
+    if sxx > 0.0 and syy > 0.0:
+        _xcorr = sxy/math.sqrt(sxx*syy)
+    _ssd = 0.0
+    if n > 0:
+        _ssd = sdd/n
+    return (_xcorr, _ssd)
+
+
+# kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
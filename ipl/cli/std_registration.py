@@ -19,7 +19,13 @@ import fcntl
 import traceback
 import collections
 import math
+import hashlib
 import argparse
+import copy
+import csv
+import multiprocessing
+
+import numpy as np
 
 # local stuff
 from   ipl.minc_tools import mincTools,mincError
@@ -38,13 +44,28 @@ def parse_options():
                     dest="verbose")
                     
     parser.add_argument("source",
+                    nargs='?',
+                    default=None,
                     help="Source file")
     
     parser.add_argument("target",
+                    nargs='?',
+                    default=None,
                     help="Target file")
     
     parser.add_argument("output_xfm",
+                    nargs='?',
+                    default=None,
                     help="Output transformation file, xfm format")
+
+    parser.add_argument("--batch",
+                    default = None,
+                    help="CSV file with source,target,output_xfm per line, registered instead of the positional pair")
+
+    parser.add_argument("--jobs",
+                    default = 1,
+                    help="Number of parallel processes in batch mode",
+                    type=int)
     
     parser.add_argument("--source_mask",
                         default= None,
@@ -94,51 +115,323 @@ def parse_options():
     parser.add_argument("--conf",
                     default="bestlinreg_s2",
                     help="Linear registrtion configuration")
+
+    parser.add_argument("--init",
+                    default = None,
+                    choices = ['fft'],
+                    help="Initialize the translation by FFT cross-correlation before fitting")
+
+    parser.add_argument("--sample-fraction",
+                    default = None,
+                    help="Evaluate the similarity on a random fraction of voxels (0..1, linear mode)",
+                    type=float,
+                    dest="sample_fraction")
     
 
     options = parser.parse_args()
+
     return options
 
 
+def _pair_tag(options):
+    """name tag unique to one source->target pair
+
+    Files that helpers drop into a shared work_dir must not collide
+    between the pairs of a --batch run executing in parallel; the full
+    paths are folded into a short hash since basenames alone can repeat
+    across subject directories.
+    """
+    s=os.path.basename(options.source ).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
+    t=os.path.basename(options.target ).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
+    h=hashlib.sha1('{}:{}'.format(os.path.abspath(options.source),
+                                  os.path.abspath(options.target)).encode())
+    return s+'_'+t+'_'+h.hexdigest()[:8]
+
+
+def _load_slabs(path, step=1):
+    """load a volume plane by plane through hyperslab reads
+
+    With step>1 only every step-th axial plane is read, so a decimated
+    view of a large volume never pulls the skipped planes off the disk
+    (the access pattern minc_qc._load_planes uses). Falls back to a
+    complete load, decimated after the fact, when the reader has no
+    hyperslab support.
+    """
+    from minc2_simple import minc2_file
+
+    m=minc2_file(path)
+    m.setup_standard_order()
+    dims=m.representation_dims()
+    # dims come back in x,y,z order while the loaded volume is z,y,x
+    shape=(dims[2].length, dims[1].length, dims[0].length)
+    idx=range(0, shape[0], step)
+    out=None
+    if hasattr(m, 'load_hyperslab'):
+        try:
+            out=np.empty((len(idx),)+shape[1:], dtype=np.float32)
+            for n,i in enumerate(idx):
+                start=[int(i), 0, 0]
+                count=[1, shape[1], shape[2]]
+                slab=m.load_hyperslab(minc2_file.MINC2_FLOAT,
+                                      start=start, count=count)
+                out[n]=np.asarray(slab).reshape(shape[1:])
+        except Exception:
+            # hyperslab reads not usable here
+            out=None
+    if out is None:
+        out=np.asarray(m.load_complete_volume(minc2_file.MINC2_FLOAT))[::step]
+    m.close()
+    return out
+
+
+def _fft_translation_init(options):
+    """estimate the gross translation by FFT cross-correlation
+
+    One O(N log N) pass over the downsampled volumes replaces the
+    exhaustive translation search of the coarsest minctracc stage. The
+    estimate is written as a translation-only xfm and handed to the
+    registration as init_xfm; the fit refines it from there. Returns
+    None (no initialization) when the optional reader is missing.
+    """
+    try:
+        from minc2_simple import minc2_file
+        import numpy as np
+    except ImportError:
+        return None
+
+    def _load(path):
+        # complete reads are fine here: the inputs are the coarse
+        # unistep temps resampled just below, a few MB each
+        m=minc2_file(path)
+        m.setup_standard_order()
+        v=m.load_complete_volume(minc2_file.MINC2_FLOAT)
+        dims=m.representation_dims()
+        m.close()
+        return v,dims
+
+    ds=options.downsample if options.downsample is not None else 4.0
+
+    with mincTools() as minc:
+        src=minc.tmp('fft_src.mnc')
+        trg=minc.tmp('fft_trg.mnc')
+        minc.resample_smooth(options.source, src, unistep=ds)
+        # same sampling for both, so the shift is a pure voxel offset
+        minc.resample_smooth(options.target, trg, like=src)
+        a,dims=_load(src)
+        b,_   =_load(trg)
+
+        a=a-a.mean()
+        b=b-b.mean()
+        cc=np.fft.irfftn(np.fft.rfftn(b)*np.conj(np.fft.rfftn(a)), s=a.shape)
+        peak=np.unravel_index(np.argmax(cc), cc.shape)
+
+        # dims are x,y,z while the volume axes are z,y,x; offsets past
+        # the half-way point wrap around to negative shifts
+        shift=[0.0,0.0,0.0]
+        for axis in range(3):
+            o=int(peak[axis])
+            n=a.shape[axis]
+            if o>n//2:
+                o-=n
+            shift[2-axis]=o*dims[2-axis].step
+
+    if options.work_dir is not None:
+        if not os.path.exists(options.work_dir):
+            os.makedirs(options.work_dir)
+        path=os.path.join(options.work_dir,
+                          'fft_init_{}.xfm'.format(_pair_tag(options)))
+    else:
+        path=os.path.join(tempfile.gettempdir(),
+                          'fft_init_{}_{}.xfm'.format(_pair_tag(options),
+                                                      os.getpid()))
+    ipl.registration._write_translation_xfm(path, shift)
+    return path
+
+
+def _make_sample_mask(options):
+    """write a deterministic random sampling mask on the source grid
+
+    The metric cost in minctracc scales with the number of mask voxels,
+    and smooth coarse stages do not need all of them. The mask is
+    intersected with --source_mask when one is given (a union would
+    defeat the thinning) and seeded deterministically so reruns match.
+    Returns the original source mask when the optional reader is
+    missing.
+    """
+    try:
+        from minc2_simple import minc2_file
+        import numpy as np
+    except ImportError:
+        return options.source_mask
+
+    ref=minc2_file(options.source)
+    ref.setup_standard_order()
+    _dims=ref.representation_dims()
+    # dims come back in x,y,z order while the written volume is z,y,x;
+    # only the shape is needed here, not the source voxels
+    shape=(_dims[2].length, _dims[1].length, _dims[0].length)
+
+    rng=np.random.default_rng(0x5a3b1e)
+    sel=rng.random(shape)<options.sample_fraction
+    if options.source_mask is not None:
+        m=minc2_file(options.source_mask)
+        m.setup_standard_order()
+        sel&=m.load_complete_volume(minc2_file.MINC2_FLOAT)>0.5
+        m.close()
+
+    if options.work_dir is not None:
+        if not os.path.exists(options.work_dir):
+            os.makedirs(options.work_dir)
+        path=os.path.join(options.work_dir,
+                          'sample_mask_{}.mnc'.format(_pair_tag(options)))
+    else:
+        path=os.path.join(tempfile.gettempdir(),
+                          'sample_mask_{}_{}.mnc'.format(_pair_tag(options),
+                                                         os.getpid()))
+
+    out=minc2_file()
+    out.define(ref.store_dims(), minc2_file.MINC2_BYTE, minc2_file.MINC2_BYTE)
+    out.create(path)
+    out.copy_metadata(ref)
+    out.setup_standard_order()
+    out.save_complete_volume(np.ascontiguousarray(sel, dtype=np.uint8))
+    out.close()
+    ref.close()
+    return path
+
+
+def _report_similarity(options):
+    """resample the source through the result and log the final metric
+
+    Cheap python-side convergence number for --verbose runs (JIT
+    compiled when numba is present); avoids re-running minctracc just
+    to print it. The metric is evaluated on every other plane: a
+    convergence check does not need every voxel, and the hyperslab
+    reads never pull the skipped half off the disk. Quietly does
+    nothing when the optional volume readers are missing.
+    """
+    try:
+        from minc2_simple import minc2_file
+        import ipl._metrics
+    except ImportError:
+        return
+
+    with mincTools() as minc:
+        resampled=minc.tmp('resampled.mnc')
+        minc.resample_smooth(options.source, resampled,
+                             transform=options.output_xfm,
+                             like=options.target)
+        a=_load_slabs(resampled, step=2)
+        b=_load_slabs(options.target, step=2)
+        mask=None
+        if options.target_mask is not None:
+            mask=_load_slabs(options.target_mask, step=2)>0.5
+        _xc,_sd=ipl._metrics.xcorr_ssd(a, b, mask=mask)
+        if options.objective=='ssd':
+            print('final ssd={:.6g} xcorr={:.6f}'.format(_sd, _xc))
+        else:
+            print('final xcorr={:.6f} ssd={:.6g}'.format(_xc, _sd))
+
+
+def _run_one(options):
+    """dispatch a single source->target registration"""
+
+
+    if options.init=='fft' and options.init_xfm is None:
+        options.init_xfm=_fft_translation_init(options)
+
+    if options.nl :
+        if options.start is None:
+            options.start=32.0
+
+        if options.downsample is None:
+            # the downsampled pyramid feeds every level including the
+            # finest, so the cap has to follow --level, not --start:
+            # the coarse levels already run on their own per-stage
+            # grids, and no stage looks at detail finer than level/4;
+            # never go below the native voxel size
+            try:
+                info=mincTools.mincinfo(options.source)
+                native=min(abs(info[i].step) for i in info)
+                ds=options.level/4.0
+                if ds>native*1.5:
+                    options.downsample=ds
+            except (OSError, ValueError):
+                pass
+
+        ipl.registration.non_linear_register_full( 
+                    options.source, options.target, options.output_xfm,
+                    source_mask= options.source_mask,
+                    target_mask= options.target_mask,
+                    init_xfm   = options.init_xfm,
+                    start      = options.start,
+                    level      = options.level,
+                    work_dir   = options.work_dir,
+                    downsample = options.downsample)
+    else:
+        if options.start is None:
+            options.start=16.0
+        _verbose=0
+        if options.verbose: _verbose=2
+
+        _source_mask=options.source_mask
+        if options.sample_fraction is not None and options.sample_fraction<1.0:
+            _source_mask=_make_sample_mask(options)
+
+        # resolve the schedule name to its immutable StageCfg list so
+        # linear_register skips the lookup and per-entry normalization
+        _conf=options.conf
+        if _conf in ipl.registration.linear_registration_config:
+            _conf=ipl.registration.linear_registration_config[_conf]
+
+        ipl.registration.linear_register(
+                    options.source, options.target, options.output_xfm,
+                    source_mask= _source_mask,
+                    target_mask= options.target_mask,
+                    init_xfm   = options.init_xfm,
+                    #start      = options.start,
+                    work_dir   = options.work_dir,
+                    downsample = options.downsample,
+                    objective  = '-'+options.objective,
+                    conf       = _conf,
+                    parameters = '-'+options.lin,
+                    verbose    = _verbose
+                    )
+
+    if options.verbose:
+        _report_similarity(options)
+
+
 def main():
     options = parse_options()
 
-    if options.source is None or options.target is None:
+    if options.batch is not None:
+        # fan a list of pairs out over worker processes: one python
+        # startup for the whole cohort, one single-threaded registration
+        # per core (workers share the thread/core pinning used by
+        # linear_register_batch)
+        jobs=[]
+        with open(options.batch) as f:
+            for row in csv.reader(f):
+                if not row or row[0].startswith('#'):
+                    continue
+                o=copy.copy(options)
+                (o.source, o.target, o.output_xfm)=row[0:3]
+                jobs.append(o)
+
+        if options.jobs>1 and len(jobs)>1:
+            ctx=multiprocessing.get_context('spawn')
+            with ctx.Pool(options.jobs,
+                          initializer=ipl.registration._batch_worker_init) as pool:
+                pool.map(_run_one, jobs)
+        else:
+            for o in jobs:
+                _run_one(o)
+    elif options.source is None or options.target is None \
+            or options.output_xfm is None:
          print("Error in arguments, run with --help")
          print(repr(options))
     else:
-        
-        if options.nl :
-            if options.start is None:
-                options.start=32.0
-            
-            ipl.registration.non_linear_register_full( 
-                        options.source, options.target, options.output_xfm,
-                        source_mask= options.source_mask,
-                        target_mask= options.target_mask,
-                        init_xfm   = options.init_xfm,
-                        start      = options.start,
-                        level      = options.level,
-                        work_dir   = options.work_dir,
-                        downsample = options.downsample)
-        else:
-            if options.start is None:
-                options.start=16.0
-            _verbose=0
-            if options.verbose: _verbose=2
-            
-            ipl.registration.linear_register(
-                        options.source, options.target, options.output_xfm,
-                        source_mask= options.source_mask,
-                        target_mask= options.target_mask,
-                        init_xfm   = options.init_xfm,
-                        #start      = options.start,
-                        work_dir   = options.work_dir,
-                        downsample = options.downsample,
-                        objective  = '-'+options.objective,
-                        conf       = options.conf,
-                        parameters = '-'+options.lin,
-                        verbose    = _verbose
-                        )
-            
+        _run_one(options)
+
 # kate: space-indent on; indent-width 4; indent-mode python;replace-tabs on;word-wrap-column 80
@@ -6,6 +6,8 @@
 # routines for creating QC images
 
 import copy
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import numpy.ma as ma
@@ -16,12 +18,28 @@ matplotlib.use('AGG')
 
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 from minc2_simple import minc2_file
 
 import matplotlib.cm  as cmx
 import matplotlib.colors as colors
 
+try:
+    from numba import njit, prange
+    have_numba=True
+except ImportError:
+    # numba not available, fall back to numpy implementation
+    have_numba=False
+
+try:
+    import numexpr as ne
+    have_numexpr=True
+except ImportError:
+    # numexpr not available either, plain numpy it is
+    have_numexpr=False
+
 try:
     unicode = unicode
 except NameError:
@@ -38,49 +56,231 @@ else:
     basestring = basestring
 
 
-def alpha_blend(si, so, ialpha, oalpha):
-    """Perform alpha-blending
+if have_numba:
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _alpha_blend_kernel(si, so, ialpha, oalpha, out):
+        """fused alpha-blending over flattened (P,4) RGBA arrays"""
+        for p in prange(si.shape[0]):
+            sa = si[p, 3]*ialpha
+            oa = so[p, 3]*oalpha
+            if oa < 1e-6:
+                # overlay is transparent here (masked background),
+                # copy the image pixel through
+                out[p, 0] = si[p, 0]
+                out[p, 1] = si[p, 1]
+                out[p, 2] = si[p, 2]
+                out[p, 3] = sa
+                continue
+            oa_c = oa*(1.0-sa)
+            out_a = sa+oa_c
+            inv = 1.0/out_a if out_a > 0.0 else 0.0
+            out[p, 0] = (si[p, 0]*sa+so[p, 0]*oa_c)*inv
+            out[p, 1] = (si[p, 1]*sa+so[p, 1]*oa_c)*inv
+            out[p, 2] = (si[p, 2]*sa+so[p, 2]*oa_c)*inv
+            out[p, 3] = out_a
+
+    @njit(parallel=True, cache=True, nogil=True)
+    def _minmax_kernel(a):
+        """single-pass NaN-aware min/max reduction over a flat array"""
+        lo = np.inf
+        hi = -np.inf
+        for p in prange(a.shape[0]):
+            v = a[p]
+            if not np.isnan(v):
+                lo = min(lo, v)
+                hi = max(hi, v)
+        return lo, hi
+
+    @njit(parallel=True, fastmath=True, cache=True, nogil=True)
+    def _over_blend_kernel(si, so, ialpha, oalpha, out):
+        """fused over-blending over flattened (P,4) RGBA arrays"""
+        for p in prange(si.shape[0]):
+            sa = si[p, 3]*ialpha
+            oa = so[p, 3]*oalpha
+            if oa < 1e-6:
+                out[p, 0] = si[p, 0]*sa
+                out[p, 1] = si[p, 1]*sa
+                out[p, 2] = si[p, 2]*sa
+                out[p, 3] = sa
+                continue
+            out[p, 0] = si[p, 0]*(sa-oa)+so[p, 0]*oa
+            out[p, 1] = si[p, 1]*(sa-oa)+so[p, 1]*oa
+            out[p, 2] = si[p, 2]*(sa-oa)+so[p, 2]*oa
+            out[p, 3] = max(sa, oa)
+
+
+def alpha_blend(si, so, ialpha, oalpha, out=None):
+    """Perform alpha-blending, optionally into a preallocated buffer
     """
+    if out is None:
+        out = np.empty_like(si)
+    if have_numba:
+        _alpha_blend_kernel(si.reshape(-1, 4), so.reshape(-1, 4),
+                            ialpha, oalpha, out.reshape(-1, 4))
+        return out
+
     si_rgb =   si[..., :3]
     si_alpha = si[..., 3]*ialpha
-    
+
     so_rgb =   so[..., :3]
     so_alpha = so[..., 3]*oalpha
-    
+
+    if have_numexpr:
+        # fused multi-threaded evaluation, no intermediate HxWx3 temporaries
+        _sia = si_alpha[..., None]
+        _soa = so_alpha[..., None]
+        out[..., 3] = ne.evaluate("sia + soa * (1.0 - sia)",
+                                  local_dict={'sia':si_alpha,'soa':so_alpha})
+        out[..., :3] = ne.evaluate(
+            "(si_rgb * sia + so_rgb * soa * (1.0 - sia)) / (sia + soa * (1.0 - sia))",
+            local_dict={'si_rgb':si_rgb,'so_rgb':so_rgb,'sia':_sia,'soa':_soa})
+        return out
+
     out_alpha = si_alpha + so_alpha * (1. - si_alpha)
-    
+
     out_rgb = (si_rgb * si_alpha[..., None] +
         so_rgb * so_alpha[..., None] * (1. - si_alpha[..., None])) / out_alpha[..., None]
-    
-    out = np.zeros_like(si)
-    out[..., :3] = out_rgb 
+
+    out[..., :3] = out_rgb
     out[..., 3]  = out_alpha
-    
+
     return out
 
 
+def _nan_minmax(a):
+    """compute nanmin and nanmax in a single pass over the volume"""
+    a = np.asarray(a)
+    if have_numba and a.flags['C_CONTIGUOUS']:
+        return _minmax_kernel(a.reshape(-1))
+    return np.nanmin(a), np.nanmax(a)
+
+
+def _build_lut(cmap, n=256):
+    """Bake a colormap into a (n,4) float32 RGBA lookup table"""
+    return cmap(np.linspace(0.0, 1.0, n)).astype(np.float32)
+
+
+def _map_rgba(slice2d, lut, vmin, scale, bg=None):
+    """Map a 2D slice through a colormap LUT, replacement for ScalarMappable.to_rgba
+
+    bg -- (optional) background threshold, pixels below it are clamped to
+          LUT entry 0, which the caller is expected to make transparent
+    """
+    s = np.asarray(slice2d)
+    idx = np.clip((s-vmin)*scale, 0, lut.shape[0]-1)
+    # NaN-s behave like the lowest bin
+    idx = np.nan_to_num(idx).astype(np.uint8)
+    if bg is not None:
+        idx[s < bg] = 0
+    return lut[idx]
+
+
 def max_blend(si,so):
-    """Perform max-blending
+    """Perform max-blending, in-place in si
     """
-    return np.maximum(si,so)
+    return np.maximum(si,so,out=si)
 
-def over_blend(si,so, ialpha, oalpha):
-    """Perform max-blending
+def over_blend(si,so, ialpha, oalpha, out=None):
+    """Perform max-blending, optionally into a preallocated buffer
     """
+    if out is None:
+        out = np.empty_like(si)
+    if have_numba:
+        _over_blend_kernel(si.reshape(-1, 4), so.reshape(-1, 4),
+                           ialpha, oalpha, out.reshape(-1, 4))
+        return out
+
     si_rgb =   si[..., :3]
     si_alpha = si[..., 3]*ialpha
-    
+
     so_rgb =   so[..., :3]
     so_alpha = so[..., 3]*oalpha
-    
+
+    if have_numexpr:
+        _sia = si_alpha[..., None]
+        _soa = so_alpha[..., None]
+        out[..., 3] = np.maximum(si_alpha, so_alpha)
+        out[..., :3] = ne.evaluate(
+            "si_rgb * (sia - soa) + so_rgb * soa",
+            local_dict={'si_rgb':si_rgb,'so_rgb':so_rgb,'sia':_sia,'soa':_soa})
+        return out
+
     out_alpha = np.maximum(si_alpha ,  so_alpha )
-    
-    out_rgb = si_rgb * (si_alpha[..., None]-so_alpha[..., None]) + so_rgb * so_alpha[..., None] 
-    
-    out = np.zeros_like(si)
-    out[..., :3] = out_rgb 
+
+    out_rgb = si_rgb * (si_alpha[..., None]-so_alpha[..., None]) + so_rgb * so_alpha[..., None]
+
+    out[..., :3] = out_rgb
     out[..., 3]  = out_alpha
-    
+
+    return out
+
+
+# reuse Figure/Axes objects across qc() calls with the same layout,
+# figure construction and teardown dominate for batch QC generation
+_FIG_CACHE = {}
+
+
+def _savefig_kwargs(output, format):
+    """extra savefig options: fast PNG compression, keep raster path"""
+    fmt = format if format is not None else os.path.splitext(output)[1].lstrip('.').lower()
+    if fmt == 'png':
+        return {'pil_kwargs': {'compress_level': 1}}
+    return {}
+
+
+def _render_axis(vol, ovl, idx, lut_img, vmin, iscale,
+                 lut_ovl=None, omin=0.0, oscale=0.0, obg=None,
+                 use_max=False, use_over=False, ialpha=0.8, oalpha=0.2,
+                 step=1):
+    """Colormap and blend a whole (N,H,W) stack of slices in one shot
+
+    vol and ovl are axis-major volumes, idx is an array of slice indices
+    along the leading axis, returns an (N,H,W,4) RGBA stack,
+    step>1 decimates the planes before colormapping
+    """
+    if step > 1:
+        vol = vol[:, ::step, ::step]
+        if ovl is not None:
+            ovl = ovl[:, ::step, ::step]
+    si = _map_rgba(vol[idx], lut_img, vmin, iscale)
+    if ovl is not None:
+        so = _map_rgba(ovl[idx], lut_ovl, omin, oscale, bg=obg)
+        if use_max:
+            si = max_blend(si, so)
+        else:
+            # one contiguous (N,H,W,4) slab for the whole axis, the
+            # per-panel images handed to imshow are views into it
+            out = np.empty_like(si)
+            if use_over: si = over_blend(si, so, ialpha, oalpha, out=out)
+            else:        si = alpha_blend(si, so, ialpha, oalpha, out=out)
+    return si
+
+
+def _load_planes(img, axis, idx, data_shape):
+    """Read only the sampled planes along one axis using hyperslab access
+
+    Returns an (N,H,W) float32 stack equivalent to slicing the axis-major
+    volume at idx, or None when the minc2 API does not support it and the
+    caller should fall back to a complete volume load
+    """
+    if not hasattr(img, 'load_hyperslab'):
+        return None
+    plane_shape = tuple(d for k,d in enumerate(data_shape) if k != axis)
+    out = np.empty((len(idx),)+plane_shape, dtype=np.float32)
+    try:
+        for n,i in enumerate(idx):
+            start=[0,0,0]
+            count=list(data_shape)
+            start[axis]=int(i)
+            count[axis]=1
+            # start/count follow the loaded (z,y,x) volume order; the
+            # reshape below catches a mismatching convention and falls
+            # back to the complete load
+            slab=img.load_hyperslab(minc2_file.MINC2_FLOAT, start=start, count=count)
+            out[n]=np.asarray(slab).reshape(plane_shape)
+    except Exception:
+        # hyperslab reads not usable here
+        return None
     return out
 
 
@@ -132,13 +332,19 @@ def qc(
     #_idata=_img.data
     _img=minc2_file(input)
     _img.setup_standard_order()
-    _idata=_img.load_complete_volume(minc2_file.MINC2_FLOAT)
     _idims=_img.representation_dims()
     
-    data_shape=_idata.shape
+    # representation dims come back in x,y,z order while the loaded
+    # volume axes are z,y,x
+    data_shape=(_idims[2].length,_idims[1].length,_idims[0].length)
     spacing=[_idims[0].step,_idims[1].step,_idims[2].step]
-    
+
+    # when explicit intensity ranges are given only the sampled planes
+    # are ever read, so try hyperslab reads and skip the full volume load
+    use_slabs = image_range is not None and (mask is None or mask_range is not None)
+
     _ovl=None
+    _idata=None
     _odata=None
     omin=0
     omax=1
@@ -146,19 +352,17 @@ def qc(
     if mask is not None:
         _ovl=minc2_file(mask)
         _ovl.setup_standard_order()
-        _ovl_data=_ovl.load_complete_volume(minc2_file.MINC2_FLOAT)
-        if _ovl_data.shape != data_shape:
-            raise "Overlay shape does not match image!\nOvl={} Image={}".format(repr(_ovl_data.shape),repr(data_shape))
+        _odims=_ovl.representation_dims()
+        ovl_shape=(_odims[2].length,_odims[1].length,_odims[0].length)
+        if ovl_shape != data_shape:
+            raise ValueError("Overlay shape does not match image!\nOvl={} Image={}".format(repr(ovl_shape),repr(data_shape)))
         if mask_range is None:
-            omin=np.nanmin(_ovl_data)
-            omax=np.nanmax(_ovl_data)
+            # keep everything float32 end to end, blending is memory-bound
+            _odata=np.ascontiguousarray(_ovl.load_complete_volume(minc2_file.MINC2_FLOAT), dtype=np.float32)
+            omin,omax=_nan_minmax(_odata)
         else:
             omin=mask_range[0]
             omax=mask_range[1]
-        _odata=_ovl_data
-        
-        if mask_bg is not None:
-            _odata=ma.masked_less(_odata, mask_bg)
         
     slices=[]
     
@@ -168,85 +372,148 @@ def qc(
         vmin=image_range[0]
         vmax=image_range[1]
     else:
-        vmin=np.nanmin(_idata)
-        vmax=np.nanmax(_idata)
+        _idata=np.ascontiguousarray(_img.load_complete_volume(minc2_file.MINC2_FLOAT), dtype=np.float32)
+        vmin,vmax=_nan_minmax(_idata)
 
     cm = copy.copy(plt.get_cmap(image_cmap))
     cmo= copy.copy(plt.get_cmap(mask_cmap))
     cmo.set_bad('k',alpha=0.0)
 
-    cNorm  = colors.Normalize(vmin=vmin, vmax=vmax)
-    oNorm  = colors.Normalize(vmin=omin, vmax=omax)
-    
-    scalarMap  = cmx.ScalarMappable(norm=cNorm, cmap=cm)
-    oscalarMap = cmx.ScalarMappable(norm=oNorm, cmap=cmo)
+    # bake both colormaps into 256-entry LUTs, mapping slices becomes
+    # a single clip+gather instead of ScalarMappable.to_rgba
+    lut_img = _build_lut(cm)
+    lut_ovl = _build_lut(cmo)
+    if mask_bg is not None:
+        # overlay pixels below mask_bg are clamped to entry 0 by _map_rgba,
+        # make that entry fully transparent (set_bad semantics, without
+        # the cost of a MaskedArray)
+        lut_ovl[0] = 0.0
+    iscale = 255.0/(vmax-vmin) if vmax>vmin else 0.0
+    oscale = 255.0/(omax-omin) if omax>omin else 0.0
     aspects = []
-    
-    # axial slices
-    for j in range(0,samples):
-        i=int( (data_shape[0]/samples)*j+(data_shape[0]%samples)/2 )
-        si=scalarMap.to_rgba(_idata[i , : ,:])
-
-        if _ovl is not None:
-            so=oscalarMap.to_rgba(_odata[i , : ,:])
-            if use_max: si=max_blend(si,so)
-            elif use_over: si=over_blend(si,so, ialpha, oalpha)
-            else: si=alpha_blend(si, so, ialpha, oalpha)
-        slices.append( si )
-        aspects.append( spacing[0]/spacing[1] )
-    # coronal slices
-    for j in range(0,samples):
-        i=int( (data_shape[1]/samples)*j+(data_shape[1]%samples)/2 )
-        si=scalarMap.to_rgba(_idata[: , i ,:])
-        
-        if _ovl is not None:
-            so=oscalarMap.to_rgba(_odata[: , i ,:])
-            if use_max: si=max_blend(si,so)
-            elif use_over: si=over_blend(si,so, ialpha, oalpha)
-            else: si=alpha_blend(si, so, ialpha, oalpha)
-        slices.append( si )
-        aspects.append( spacing[2]/spacing[0] )
-        
-    # sagittal slices
-    for j in range(0,samples):
-        i=int( (data_shape[2]/samples)*j+(data_shape[2]%samples)/2 )
-        si=scalarMap.to_rgba(_idata[: , : , i])
-        if _ovl is not None:
-            so=oscalarMap.to_rgba(_odata[: , : , i])
-            if use_max: si=max_blend(si,so)
-            elif use_over: si=over_blend(si,so, ialpha, oalpha)
-            else: si=alpha_blend(si, so, ialpha, oalpha)
-        slices.append( si )
-        aspects.append( spacing[2]/spacing[1] )
-        
+
+    # slice indices along each axis, same arithmetic as the old scalar loop
+    _j = np.arange(samples)
+    idx_ax  = ((data_shape[0]/samples)*_j+(data_shape[0]%samples)/2).astype(int)
+    idx_cor = ((data_shape[1]/samples)*_j+(data_shape[1]%samples)/2).astype(int)
+    idx_sag = ((data_shape[2]/samples)*_j+(data_shape[2]%samples)/2).astype(int)
+
+    # decimate high-resolution planes down to the output pixel budget,
+    # matplotlib would downscale them to dpi resolution anyway
     w, h = plt.figaspect(3.0/samples)
-    fig = plt.figure(figsize=(w,h))
-    
-    #outer_grid = gridspec.GridSpec((len(slices)+1)/2, 2, wspace=0.0, hspace=0.0)
-    ax=None
-    imgplot=None
-    for i,j in enumerate(slices):
-        ax =  plt.subplot2grid( (3, samples), (  int( i/samples) , i%samples) )
-        imgplot = ax.imshow(j,origin='lower',cmap=cm, aspect=aspects[i])
-        ax.set_xticks([])
-        ax.set_yticks([])
-        ax.title.set_visible(False)
+    panel_h = h*dpi/3.0
+    panel_w = w*dpi/samples
+
+    def _dec_step(hh, ww):
+        st = int(min(hh/panel_h, ww/panel_w))
+        return st if st >= 2 else 1
+
+    step_ax  = _dec_step(data_shape[1], data_shape[2])
+    step_cor = _dec_step(data_shape[0], data_shape[2])
+    step_sag = _dec_step(data_shape[0], data_shape[1])
+
+    render_jobs = None
+    if use_slabs and _idata is None:
+        vol_ax  = _load_planes(_img, 0, idx_ax,  data_shape)
+        vol_cor = _load_planes(_img, 1, idx_cor, data_shape)
+        vol_sag = _load_planes(_img, 2, idx_sag, data_shape)
+        ovl_ax = ovl_cor = ovl_sag = None
+        if _ovl is not None and vol_ax is not None:
+            ovl_ax  = _load_planes(_ovl, 0, idx_ax,  data_shape)
+            ovl_cor = _load_planes(_ovl, 1, idx_cor, data_shape)
+            ovl_sag = _load_planes(_ovl, 2, idx_sag, data_shape)
+        if vol_ax is not None and vol_cor is not None and vol_sag is not None            and (_ovl is None or (ovl_ax is not None and ovl_cor is not None and ovl_sag is not None)):
+            _idx = np.arange(samples)
+            render_jobs = [
+                (vol_ax,  ovl_ax,  _idx, step_ax,  spacing[0]/spacing[1]),
+                (vol_cor, ovl_cor, _idx, step_cor, spacing[2]/spacing[0]),
+                (vol_sag, ovl_sag, _idx, step_sag, spacing[2]/spacing[1]),
+                ]
+
+    if render_jobs is None:
+        # full-volume path: load whatever was not needed for the ranges,
+        # then pre-transpose once per axis so that every coronal and
+        # sagittal plane is extracted as a C-contiguous 2D array
+        if _idata is None:
+            _idata=np.ascontiguousarray(_img.load_complete_volume(minc2_file.MINC2_FLOAT), dtype=np.float32)
+        if _ovl is not None and _odata is None:
+            _odata=np.ascontiguousarray(_ovl.load_complete_volume(minc2_file.MINC2_FLOAT), dtype=np.float32)
+        _idata_cor = np.ascontiguousarray(_idata.transpose(1,0,2))
+        _idata_sag = np.ascontiguousarray(_idata.transpose(2,0,1))
+        _odata_cor = _odata_sag = None
+        if _odata is not None:
+            _odata_cor = np.ascontiguousarray(_odata.transpose(1,0,2))
+            _odata_sag = np.ascontiguousarray(_odata.transpose(2,0,1))
+        render_jobs = [
+            (_idata,     _odata,     idx_ax,  step_ax,  spacing[0]/spacing[1]),
+            (_idata_cor, _odata_cor, idx_cor, step_cor, spacing[2]/spacing[0]),
+            (_idata_sag, _odata_sag, idx_sag, step_sag, spacing[2]/spacing[1]),
+            ]
+
+    # extract each axis as one (N,H,W) stack and colormap/blend it in one
+    # go; the three axes are independent and share read-only volumes, so
+    # run them concurrently (the numba kernels release the GIL)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        futures = [
+            (pool.submit(_render_axis, vol, ovl, idx,
+                         lut_img, vmin, iscale, lut_ovl, omin, oscale, mask_bg,
+                         use_max, use_over, ialpha, oalpha, step), asp)
+            for vol, ovl, idx, step, asp in render_jobs ]
+        for fut, asp in futures:
+            for si in fut.result():
+                slices.append( si )
+                aspects.append( asp )
+        
+    # colorbar attaches extra axes, do not cache those figures
+    key = (3, samples, round(w,2), round(h,2)) if not show_image_bar else None
+    cached = _FIG_CACHE.get(key) if key is not None else None
+
+    if cached is None:
+        # build the Figure directly, skipping the pyplot state machine
+        # and its figure registry
+        fig = Figure(figsize=(w,h))
+        FigureCanvasAgg(fig)
+        # build the whole axes grid at once, no per-slice gridspec recomputation
+        axes = fig.subplots(3, samples, squeeze=False,
+                            gridspec_kw={'wspace':0.0,'hspace':0.0})
+        imgs=[]
+        for ax,j,asp in zip(axes.flat, slices, aspects):
+            # nearest: the planes were already decimated to the pixel budget
+            imgs.append( ax.imshow(j,origin='lower',cmap=cm, aspect=asp,
+                                   interpolation='nearest') )
+            ax.set_xticks([])
+            ax.set_yticks([])
+            ax.title.set_visible(False)
+            # keep vector backends (pdf/svg) on the raster path
+            ax.set_rasterized(True)
+        if key is not None:
+            _FIG_CACHE[key] = (fig, axes, imgs)
+    else:
+        (fig, axes, imgs) = cached
+        for im,ax,j,asp in zip(imgs, axes.flat, slices, aspects):
+            im.set_data(j)
+            im.set_extent((-0.5, j.shape[1]-0.5, -0.5, j.shape[0]-0.5))
+            ax.set_aspect(asp)
+    imgplot = imgs[-1]
+
     # show for the last plot
     if show_image_bar:
         cbar = fig.colorbar(imgplot)
     
     
     if title is not None:
-        plt.suptitle(title,fontsize=20)
-        plt.subplots_adjust(wspace = 0.0 ,hspace=0.0)
+        fig.suptitle(title,fontsize=20)
+        fig.subplots_adjust(top=0.95,bottom=0.0,left=0.0,right=1.0,wspace = 0.0 ,hspace=0.0)
     else:
-        plt.subplots_adjust(top=1.0,bottom=0.0,left=0.0,right=1.0,wspace = 0.0 ,hspace=0.0)
+        # clear any title left over on a cached figure
+        fig.suptitle('')
+        fig.subplots_adjust(top=1.0,bottom=0.0,left=0.0,right=1.0,wspace = 0.0 ,hspace=0.0)
     
     #fig.tight_layout()
-    #plt.show()
-    plt.savefig(output, bbox_inches='tight', dpi=dpi,format=format)
-    plt.close()
-    plt.close('all')
+    # no bbox_inches='tight' : it re-renders the figure a second time
+    # just to measure the bounding box
+    fig.savefig(output, dpi=dpi, format=format, **_savefig_kwargs(output,format))
+    # uncached figures are reclaimed by the GC, nothing to close
 
 def qc_field_contour(
     input,
@@ -265,7 +532,7 @@ def qc_field_contour(
     
     _img=minc2_file(input)
     _img.setup_standard_order()
-    _idata=_img.load_complete_volume(minc2_file.MINC2_FLOAT)
+    _idata=np.ascontiguousarray(_img.load_complete_volume(minc2_file.MINC2_FLOAT), dtype=np.float32)
     _idims=_img.representation_dims()
     
     data_shape=_idata.shape
@@ -279,8 +546,7 @@ def qc_field_contour(
         vmin=image_range[0]
         vmax=image_range[1]
     else:
-        vmin=np.nanmin(_idata)
-        vmax=np.nanmax(_idata)
+        vmin,vmax=_nan_minmax(_idata)
 
     cm = plt.get_cmap(image_cmap)
 
@@ -288,91 +554,67 @@ def qc_field_contour(
     
     scalarMap  = cmx.ScalarMappable(norm=cNorm, cmap=cm)
     
-    for j in range(0,samples):
-        i=(data_shape[0]/samples)*j+(data_shape[0]%samples)/2
-        si=_idata[i , : ,:]
-        slices.append( si )
-        
-    for j in range(0,samples):
-        i=(data_shape[1]/samples)*j+(data_shape[1]%samples)/2
-        si=_idata[: , i ,:]
-        slices.append( si )
-        
-    for j in range(0,samples):
-        i=(data_shape[2]/samples)*j+(data_shape[2]%samples)/2
-        si=_idata[: , : , i]
-        slices.append( si )
+    # slice indices along each axis, computed in one vectorized pass
+    _j = np.arange(samples)
+    idx_ax  = ((data_shape[0]/samples)*_j+(data_shape[0]%samples)/2).astype(int)
+    idx_cor = ((data_shape[1]/samples)*_j+(data_shape[1]%samples)/2).astype(int)
+    idx_sag = ((data_shape[2]/samples)*_j+(data_shape[2]%samples)/2).astype(int)
+
+    for i in idx_ax:
+        slices.append( _idata[i , : ,:] )
+
+    for i in idx_cor:
+        slices.append( _idata[: , i ,:] )
+
+    for i in idx_sag:
+        slices.append( _idata[: , : , i] )
     
     w, h = plt.figaspect(3.0/samples)
-    fig = plt.figure(figsize=(w,h))
+    fig = Figure(figsize=(w,h))
+    FigureCanvasAgg(fig)
     
-    #outer_grid = gridspec.GridSpec((len(slices)+1)/2, 2, wspace=0.0, hspace=0.0)
-    ax=None
+    axes = fig.subplots(3, samples, squeeze=False,
+                        gridspec_kw={'wspace':0.0,'hspace':0.0})
     imgplot=None
-    for i,j in enumerate(slices):
-        ax =  plt.subplot2grid( (3, samples), (i/samples, i%samples) )
-        imgplot = ax.contour(j,origin='lower', cmap=cm, norm=cNorm, levels=np.linspace(vmin,vmax,20))
+    # compute the level set once, and per plane only contour the levels
+    # the plane actually crosses (single fused min/max pass per plane)
+    levels = np.linspace(vmin,vmax,20)
+    for ax,j in zip(axes.flat, slices):
+        jmin,jmax = _nan_minmax(j)
+        _levels = levels[(levels>=jmin)&(levels<=jmax)]
+        if _levels.shape[0]==0:
+            _levels = levels
+        imgplot = ax.contour(j,origin='lower', cmap=cm, norm=cNorm, levels=_levels)
         #plt.clabel(imgplot, inline=1, fontsize=8)
         ax.set_xticks([])
         ax.set_yticks([])
         ax.title.set_visible(False)
+        ax.set_rasterized(True)
     # show for the last plot
     if show_image_bar:
         cbar = fig.colorbar(imgplot)
     
     
     if title is not None:
-        plt.suptitle(title,fontsize=20)
-        plt.subplots_adjust(wspace = 0.0 ,hspace=0.0)
+        fig.suptitle(title,fontsize=20)
+        fig.subplots_adjust(top=0.95,bottom=0.0,left=0.0,right=1.0,wspace = 0.0 ,hspace=0.0)
     else:
-        plt.subplots_adjust(top=1.0,bottom=0.0,left=0.0,right=1.0,wspace = 0.0 ,hspace=0.0)
+        fig.subplots_adjust(top=1.0,bottom=0.0,left=0.0,right=1.0,wspace = 0.0 ,hspace=0.0)
     
-    plt.savefig(output, bbox_inches='tight', dpi=dpi)
-    plt.close('all')
-
-
-# register custom maps
-plt.register_cmap(cmap=colors.LinearSegmentedColormap('red',
-    {'red':   ((0.0, 0.0, 0.0),
-                (1.0, 1.0, 1.0)),
-
-      'green': ((0.0, 0.0, 0.0),
-                (1.0, 0.0, 0.0)),
-
-      'blue':  ((0.0, 0.0, 0.0),
-                (1.0, 0.0, 0.0)),
-      
-      'alpha':  ((0.0, 0.0, 1.0),
-                (1.0, 1.0, 1.0))         
-    }))
-      
-plt.register_cmap(cmap=colors.LinearSegmentedColormap('green', 
-    {'green': ((0.0, 0.0, 0.0),
-                (1.0, 1.0, 1.0)),
-
-      'red':   ((0.0, 0.0, 0.0),
-                (1.0, 0.0, 0.0)),
-
-      'blue':  ((0.0, 0.0, 0.0),
-                (1.0, 0.0, 0.0)),
-
-      'alpha': ((0.0, 0.0, 1.0),
-                (1.0, 1.0, 1.0))         
-    }))
-
-plt.register_cmap(cmap=colors.LinearSegmentedColormap('blue', 
-    {'blue':  ((0.0, 0.0, 0.0),
-                (1.0, 1.0, 1.0)),
-
-      'red':   ((0.0, 0.0, 0.0),
-                (1.0, 0.0, 0.0)),
-
-      'green': ((0.0, 0.0, 0.0),
-                (1.0, 0.0, 0.0)),
-      
-      'alpha': ((0.0, 0.0, 1.0),
-                (1.0, 1.0, 1.0))         
-    }))
+    fig.savefig(output, dpi=dpi, **_savefig_kwargs(output,format))
+
+
+# register custom maps: precomputed 256-entry tables, colormap lookup
+# becomes a plain array index instead of segment interpolation
+def _register_ramp_cmap(name, channel):
+    table = np.zeros((256, 4), np.float32)
+    table[:, channel] = np.linspace(0.0, 1.0, 256)
+    table[:, 3] = 1.0
+    plt.register_cmap(cmap=colors.ListedColormap(table, name=name))
+
+_register_ramp_cmap('red',   0)
+_register_ramp_cmap('green', 1)
+_register_ramp_cmap('blue',  2)
 
 
 if __name__ == '__main__':
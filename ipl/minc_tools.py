@@ -23,6 +23,19 @@ import logging
 
 import inspect
 
+try:
+    from minc2_simple import minc2_file
+    import numpy as np
+    have_minc2_simple=True
+except ImportError:
+    # minc2_simple not available :(
+    have_minc2_simple=False
+
+try:
+    import scipy.ndimage
+    have_scipy=True
+except ImportError:
+    have_scipy=False
 
 logger = logging.getLogger("MINC")
 logger.setLevel(logging.DEBUG)
@@ -1447,8 +1460,17 @@ class mincTools(temp_files):
         dy=False,
         dz=False,
         output_float=False,
+        fast=False,
         ):
-        """Apply gauissian blurring to the input image"""
+        """Apply gauissian blurring to the input image
+        
+        fast -- use a small truncated FIR kernel in-memory (low sigma only),
+                falls back to fast_blur when not applicable
+        """
+
+        if fast and have_minc2_simple and not (gmag or dx or dy or dz):
+            if self._blur_small_kernel(input, output, fwhm):
+                return
 
         cmd = ['fast_blur', input, output, '--fwhm', str(fwhm)]
         if gmag:
@@ -1463,6 +1485,74 @@ class mincTools(temp_files):
             cmd.append('--float')
         self.command(cmd, inputs=[input], outputs=[output], verbose=self.verbose)
 
+    @staticmethod
+    def blur_inmemory(vol, fwhm, voxel_size, truncate=3.0):
+        """separable in-memory Gaussian blur of a numpy volume
+
+        Arguments:
+        vol -- numpy array (z,y,x order)
+        fwhm -- kernel full width at half maximum, in mm
+        voxel_size -- scalar or per-axis (z,y,x) voxel size in mm
+        truncate -- cut the kernel off at this many sigmas, default 3
+
+        Three gaussian_filter1d passes are O(3*N*k) instead of the
+        O(N*k^3) dense kernel, and nothing round-trips through a file.
+        Requires scipy.
+        """
+        try:
+            voxel_size=[float(v) for v in voxel_size]
+        except TypeError:
+            voxel_size=[float(voxel_size)]*3
+        for axis in range(3):
+            sigma=fwhm/(2.0*math.sqrt(2.0*math.log(2.0))*abs(voxel_size[axis]))
+            if sigma < 1e-3:
+                continue
+            vol=scipy.ndimage.gaussian_filter1d(vol, sigma, axis=axis,
+                                                truncate=truncate)
+        return vol
+
+    def _blur_small_kernel(self, input, output, fwhm):
+        """separable blur with a fixed 5/7/9-tap FIR kernel, in-memory
+
+        only worth it (and only accurate) when sigma is around a voxel or
+        less; returns False when the kernel would be too wide so that the
+        caller can fall back to fast_blur
+        """
+        in_minc=minc2_file(input)
+        in_minc.setup_standard_order()
+        dims=in_minc.representation_dims()
+        # sigma in voxels, per dimension (dims are in x,y,z order)
+        sigma=[fwhm/(2.0*math.sqrt(2.0*math.log(2.0))*abs(d.step)) for d in dims]
+        # 5/7/9 taps cover 3 sigma for sigma up to ~1.33 voxels
+        if max(sigma) > 4.0/3.0:
+            in_minc.close()
+            return False
+        vol=in_minc.load_complete_volume(minc2_file.MINC2_FLOAT)
+
+        if have_scipy:
+            vol=self.blur_inmemory(vol, fwhm,
+                                   [abs(d.step) for d in reversed(dims)])
+        else:
+            for axis in range(3):
+                s_=sigma[2-axis] # volume axes are z,y,x
+                if s_ < 1e-3 :
+                    continue
+                radius=max(2, int(math.ceil(3.0*s_)))
+                x=np.arange(-radius, radius+1)
+                k=np.exp(-0.5*(x/s_)**2).astype(np.float32)
+                k/=k.sum()
+                vol=np.apply_along_axis(np.convolve, axis, vol, k, mode='same')
+
+        out=minc2_file()
+        out.define(in_minc.store_dims(), minc2_file.MINC2_FLOAT, minc2_file.MINC2_FLOAT)
+        out.create(output)
+        out.copy_metadata(in_minc)
+        out.setup_standard_order()
+        out.save_complete_volume(np.ascontiguousarray(vol, dtype=np.float32))
+        out.close()
+        in_minc.close()
+        return True
+
     def blur_orig(
         self,
         input,
@@ -2108,32 +2198,58 @@ class mincTools(temp_files):
         self.command(cmd, inputs=inputs,outputs=[output], verbose=self.verbose)
         
         
-    def downsample_registration_files(self, sources, targets, source_mask, target_mask, downsample=None):
+    def downsample_registration_files(self, sources, targets, source_mask, target_mask, downsample=None, cache=None, datatype=None):
+        """downsample registration inputs to a given uniform step
+
+        cache -- (optional) cache_files object: allocate the downsampled
+        volumes there instead of the run-local temp dir, so with a
+        persistent work_dir the pyramid is built once and reused by
+        every stage and every subsequent run
+        datatype -- (optional) storage type for the downsampled images,
+        e.g. 'short' to halve the bandwidth of everything reading them;
+        masks are always stored as byte
+        """
         if downsample is not None:
+            alloc = cache.cache if cache is not None else self.tmp
+            # cache() leaves the slot flock'ed: release each one as
+            # soon as its file is produced, otherwise parallel runs
+            # sharing a work_dir (and hence the target slots) serialize
+            # on each other's entire registration instead of the resample
+            unlock = cache.unlock if cache is not None else (lambda _f: None)
             sources_lr=[]
             targets_lr=[]
             for _s,_ in enumerate(sources):
                 s_base=os.path.basename(sources[_s]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
                 t_base=os.path.basename(targets[_s]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
-                
-                source_lr=self.tmp(s_base+'_'+str(downsample)+'_'+str(_s)+'.mnc')
-                target_lr=self.tmp(t_base+'_'+str(downsample)+'_'+str(_s)+'.mnc')
+                if t_base==s_base:
+                    # same basename in different directories would
+                    # silently share (and overwrite) cache slots
+                    t_base=t_base+'_trg'
+
+                source_lr=alloc(s_base+'_'+str(downsample)+'_'+str(_s)+'.mnc')
+                target_lr=alloc(t_base+'_'+str(downsample)+'_'+str(_s)+'.mnc')
+
+                self.resample_smooth(sources[_s],source_lr,unistep=downsample,datatype=datatype)
+                unlock(source_lr)
+                self.resample_smooth(targets[_s],target_lr,unistep=downsample,datatype=datatype)
+                unlock(target_lr)
 
-                self.resample_smooth(sources[_s],source_lr,unistep=downsample)
-                self.resample_smooth(targets[_s],target_lr,unistep=downsample)
-                
                 sources_lr.append(source_lr)
                 targets_lr.append(target_lr)
-            
+
             # downsample mask
             if source_mask is not None:
-                source_mask_lr=self.tmp(s_base+'_mask_'+str(downsample)+'.mnc')
-                self.resample_labels(source_mask,source_mask_lr,unistep=downsample,datatype='byte')
+                source_mask_lr=alloc(s_base+'_mask_'+str(downsample)+'.mnc')
+                if not os.path.exists(source_mask_lr):
+                    self.resample_labels(source_mask,source_mask_lr,unistep=downsample,datatype='byte')
+                unlock(source_mask_lr)
             else:
                 source_mask_lr=None
             if target_mask is not None:
-                target_mask_lr=self.tmp(t_base+'_mask_'+str(downsample)+'.mnc')
-                self.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+                target_mask_lr=alloc(t_base+'_mask_'+str(downsample)+'.mnc')
+                if not os.path.exists(target_mask_lr):
+                    self.resample_labels(target_mask,target_mask_lr,unistep=downsample,datatype='byte')
+                unlock(target_mask_lr)
             else:
                 target_mask_lr=None
 
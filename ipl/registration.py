@@ -6,15 +6,13 @@
 #
 # registration tools
 import os
-import sys
 import shutil
-import tempfile
-import subprocess
 import re
 import fcntl
-import traceback
+import hashlib
 import collections
-import math
+
+import numpy as np
 
 # local stuff
 import ipl.minc_tools
@@ -38,220 +36,336 @@ else:
     
     
 
+def _blur_cache_key(path, blur, fwhm):
+    """content-addressed key for a blurred volume: input identity + blur signature"""
+    st = os.stat(path)
+    h = hashlib.sha1('{}:{}:{}:{}:{}'.format(
+        os.path.abspath(path), st.st_mtime_ns, st.st_size, blur, fwhm).encode())
+    return h.hexdigest()[:16]
+
+
+def _min_step(path):
+    """smallest absolute voxel step of a minc volume"""
+    info = ipl.minc_tools.mincTools.mincinfo(path)
+    return min(abs(info[i].step) for i in info)
+
+
+def _xfm_invert_py(xfm_in, xfm_out):
+    """invert a purely linear XFM analytically, avoiding an xfminvert call
+
+    Returns False (leaving xfm_out untouched) when the file is anything
+    other than a single linear transform, so the caller can fall back
+    to the external tool.
+    """
+    with open(xfm_in) as f:
+        txt = f.read()
+    if txt.count('Linear_Transform') != 1 or 'Grid_Transform' in txt:
+        return False
+    m = re.search(r'Linear_Transform\s*=([^;]+);', txt)
+    if m is None:
+        return False
+    v = [float(x) for x in m.group(1).split()]
+    if len(v) != 12:
+        return False
+    mat = np.vstack((np.asarray(v).reshape(3, 4), [0.0, 0.0, 0.0, 1.0]))
+    inv = np.linalg.inv(mat)
+    with open(xfm_out, 'w') as f:
+        f.write('MNI Transform File\n')
+        f.write('% inverted from {}\n'.format(os.path.basename(xfm_in)))
+        f.write('\nTransform_Type = Linear;\nLinear_Transform =\n')
+        f.write('\n'.join(' '.join(repr(float(x)) for x in inv[r, :])
+                           for r in range(3)) + ';\n')
+    return True
+
+
+def _write_translation_xfm(path, translation):
+    """write a pure-translation linear XFM without calling param2xfm"""
+    with open(path, 'w') as f:
+        f.write('MNI Transform File\n'
+                '\nTransform_Type = Linear;\nLinear_Transform =\n'
+                '1 0 0 {}\n0 1 0 {}\n0 0 1 {};\n'.format(
+                    repr(float(translation[0])),
+                    repr(float(translation[1])),
+                    repr(float(translation[2]))))
+
+
+_com_cache = {}
+
+
+def _center_of_mass(minc, path):
+    """center of mass of a volume in world coordinates
+
+    cached on (path, mtime): cohort runs ask for the same CoM over and
+    over and each mincstats call costs a fork/exec
+    """
+    key = (os.path.abspath(path), os.stat(path).st_mtime_ns)
+    if key not in _com_cache:
+        _com_cache[key] = minc.stats(path, ['-com', '-world_only'],
+                                     single_value=False)
+    return _com_cache[key]
+
+
+def _blur_cached(minc, tmp, input, name, gmag, fwhm, blur, cache_dir=None, fast=False):
+    """blur a volume, optionally through a persistent content-addressed cache
+
+    cache_dir (or the IPL_BLUR_CACHE environment variable) points to a
+    directory shared between runs: identical (input, blur, fwhm)
+    combinations are blurred only once, concurrent access is serialized
+    with a file lock. Without a cache dir this behaves like the old
+    per-invocation tmp.cache() path.
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('IPL_BLUR_CACHE')
+
+    if cache_dir is None:
+        # cache() leaves the slot flock'ed; release it as soon as the
+        # file exists so parallel registrations sharing a work_dir wait
+        # for the blur, not for the whole run holding the lock
+        fname = tmp.cache(name)
+        try:
+            if not os.path.exists(fname):
+                minc.blur(input, fname, gmag=gmag, fwhm=fwhm, fast=fast)
+        finally:
+            tmp.unlock(fname)
+        return fname
+
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # another process won the race
+            pass
+
+    cached = os.path.join(cache_dir, _blur_cache_key(input, blur, fwhm)+'.mnc')
+    lock = open(cached+'.lock', 'a')
+    try:
+        fcntl.lockf(lock.fileno(), fcntl.LOCK_EX)
+        if not os.path.exists(cached):
+            minc.blur(input, cached, gmag=gmag, fwhm=fwhm, fast=fast)
+    finally:
+        fcntl.lockf(lock.fileno(), fcntl.LOCK_UN)
+        lock.close()
+    return cached
+
+
+StageCfg = collections.namedtuple('StageCfg',
+    ['blur', 'trans', 'blur_fwhm', 'steps', 'tolerance', 'simplex',
+     'parameters', 'reverse'], defaults=(None, False))
+
+
 linear_registration_config={
     'bestlinreg': [
-              {  "blur"       : "blur",
-                  "trans"      : ['-est_translations'],
-                  "blur_fwhm"  : 16,
-                  "steps"      : [8, 8, 8],
-                  "tolerance"  : 0.01,
-                  "simplex"    : 32 },
-
-              {  "blur"       : "blur",
-                  "trans"      : None,
-                  "blur_fwhm"  : 8,
-                  "steps"      : [4, 4, 4],
-                  "tolerance"  : 0.004,
-                  "simplex"    : 16 },
-
-              {  "blur"       : "blur",
-                  "trans"      : None,
-                  "blur_fwhm"  : 4,
-                  "steps"      : [4, 4, 4],
-                  "tolerance"  : 0.004,
-                  "simplex"    : 8 },
-
-              { "blur"       : "dxyz",
-                  "trans"      : None,
-                  "blur_fwhm"  : 8,
-                  "steps"      : [4, 4, 4],
-                  "tolerance"  : 0.004,
-                  "simplex"    : 4 },
-
-              {  "blur"       : "dxyz",
-                  "trans"      : None,
-                  "blur_fwhm"  : 4,
-                  "steps"      : [4, 4, 4],
-                  "tolerance"  : 0.004,
-                  "simplex"    : 2 }
-          ],
-              
-     'bestlinreg_s': [
-            { "blur"        : "blur",
-                "trans"       : ['-est_translations'],
-                "blur_fwhm"   : 16,
-                "steps"       : [8,8,8],
-                "tolerance"   : 0.01,
-                "simplex"     : 32 },
-
-            { "blur"        : "blur",
-                "trans"       : None,
-                "blur_fwhm"   : 8,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 16 },
-
-            { "blur"        : "blur",       
-                "trans"       : None,
-                "blur_fwhm"   : 8,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.0001,
-                "simplex"     : 16 },
-
-            { "blur"        : "blur",
-                "trans"       : None,
-                "blur_fwhm"   : 4,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.0001,
-                "simplex"     : 8 },
-
-            { "blur"        : "blur",
-                "trans"       : None,
-                "blur_fwhm"   : 2,
-                "steps"       : [2,2,2],
-                "tolerance"   : 0.0005,
-                "simplex"     : 4 }         
-         ],
-            
-     'bestlinreg_s2': [
-            { "blur"        : "blur",
-                "trans"       : ['-est_translations'],
-                "blur_fwhm"   : 16,
-                "steps"       : [8,8,8],
-                "tolerance"   : 0.01,
-                "simplex"     : 32 },
-
-            { "blur"        : "blur",
-                "trans"       : None,
-                "blur_fwhm"   : 8,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 16 },
-
-            { "blur"        : "blur",
-                "trans"       : None,
-                "blur_fwhm"   : 4,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 8 },
-
-            { "blur"        : "dxyz",
-                "trans"       : None,
-                "blur_fwhm"   : 8,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 4 },
-
-            { "blur"        : "dxyz",
-                "trans"       : None,
-                "blur_fwhm"   : 4,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 2 }
-         ],
-            
-     'experiment_1': [
-            { "blur"        : "blur",
-                "trans"       : ['-est_translations'],
-                "blur_fwhm"   : 8,
-                "steps"       : [8,8,8],
-                "tolerance"   : 0.01,
-                "simplex"     : 32 },
-
-            { "blur"        : "blur",
-                "trans"       : None,
-                "blur_fwhm"   : 8,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 16 },
-
-            { "blur"        : "blur",
-                "trans"       : None,
-                "blur_fwhm"   : 4,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 8 },
-
-            { "blur"        : "dxyz",
-                "trans"       : None,
-                "blur_fwhm"   : 8,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 4 },
-
-            { "blur"        : "dxyz",
-                "trans"       : None,
-                "blur_fwhm"   : 4,
-                "steps"       : [4,4,4],
-                "tolerance"   : 0.004,
-                "simplex"     : 2 }
-         ],
-            
-    'bestlinreg_new': [      # re-imelementation from Claude's bestlinreg ~ 2016-12-01
-        {   'blur'        : "blur",       # -lsq7 scaling only
-            'parameters'  : "-lsq6",
-            'trans'       : ['-est_translations'],
-            'blur_fwhm'   : 8,
-            'steps'       : [4, 4, 4],
-            'tolerance'   : 0.0001,
-            'simplex'     : 16 },
-
-        {   'blur'        : "blur",       # -lsqXX full options
-            'parameters'  : "-lsq7",
-            'trans'       : None,
-            'blur_fwhm'   : 8,
-            'steps'       : [4, 4, 4],
-            'tolerance'   : 0.0001,
-            'simplex'     : 16 },
-
-        {   'blur'        : "blur",
-            'trans'       : None,
-            'blur_fwhm'   : 4,
-            'steps'       : [4, 4, 4],
-            'tolerance'   : 0.0001,
-            'simplex'     : 8 },
-
-        {   'blur'        : "blur",
-            'trans'       : None,
-            'blur_fwhm'   : 2,
-            'steps'       : [2, 2, 2],
-            'tolerance'   : 0.0005,
-            'simplex'     : 4 }
+        StageCfg(blur='blur',
+                 trans=('-est_translations',),
+                 blur_fwhm=16,
+                 steps=(8, 8, 8),
+                 tolerance=0.01,
+                 simplex=32),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=16),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=8),
+
+        StageCfg(blur='dxyz',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=4),
+
+        StageCfg(blur='dxyz',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=2),
+        ],
+
+    'bestlinreg_s': [
+        StageCfg(blur='blur',
+                 trans=('-est_translations',),
+                 blur_fwhm=16,
+                 steps=(8, 8, 8),
+                 tolerance=0.01,
+                 simplex=32),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=16),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.0001,
+                 simplex=16),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.0001,
+                 simplex=8),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=2,
+                 steps=(2, 2, 2),
+                 tolerance=0.0005,
+                 simplex=4),
+        ],
+
+    'bestlinreg_s2': [
+        StageCfg(blur='blur',
+                 trans=('-est_translations',),
+                 blur_fwhm=16,
+                 steps=(8, 8, 8),
+                 tolerance=0.01,
+                 simplex=32),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=16),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=8),
+
+        StageCfg(blur='dxyz',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=4),
+
+        StageCfg(blur='dxyz',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=2),
+        ],
+
+    'experiment_1': [
+        StageCfg(blur='blur',
+                 trans=('-est_translations',),
+                 blur_fwhm=8,
+                 steps=(8, 8, 8),
+                 tolerance=0.01,
+                 simplex=32),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=16),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=8),
+
+        StageCfg(blur='dxyz',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=4),
+
+        StageCfg(blur='dxyz',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.004,
+                 simplex=2),
+        ],
+
+    'bestlinreg_new': [
+        StageCfg(blur='blur',
+                 trans=('-est_translations',),
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.0001,
+                 simplex=16,
+                 parameters='-lsq6'),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.0001,
+                 simplex=16,
+                 parameters='-lsq7'),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.0001,
+                 simplex=8),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=2,
+                 steps=(2, 2, 2),
+                 tolerance=0.0005,
+                 simplex=4),
+        ],
+
+    'bestlinreg_20180117': [
+        StageCfg(blur='blur',
+                 trans=('-est_translations',),
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.0001,
+                 simplex=16,
+                 parameters='-lsq6'),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=8,
+                 steps=(4, 4, 4),
+                 tolerance=0.0001,
+                 simplex=16,
+                 parameters='-lsq7'),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=4,
+                 steps=(4, 4, 4),
+                 tolerance=0.0001,
+                 simplex=8),
+
+        StageCfg(blur='blur',
+                 trans=None,
+                 blur_fwhm=2,
+                 steps=(2, 2, 2),
+                 tolerance=1e-07,
+                 simplex=4,
+                 reverse=True),
         ],
-        
-    'bestlinreg_20180117': [      # re-imelementation from Claude's bestlinreg ~ 2016-12-01
-        {   'blur'        : "blur",       # -lsq7 scaling only
-            'parameters'  : "-lsq6",
-            'trans'       : [ '-est_translations' ],
-            'blur_fwhm'   : 8,
-            'steps'       : [4, 4, 4],
-            'tolerance'   : 0.0001,
-            'simplex'     : 16 },
-
-        {   'blur'        : "blur",       # -lsqXX full options
-            'parameters'  : "-lsq7",
-            'trans'       : None,
-            'blur_fwhm'   : 8,
-            'steps'       : [4, 4, 4],
-            'tolerance'   : 0.0001,
-            'simplex'     : 16 },
-
-        {   'blur'        : "blur",
-            'trans'       : None,
-            'blur_fwhm'   : 4,
-            'steps'       : [4, 4, 4],
-            'tolerance'   : 0.0001,
-            'simplex'     : 8 },
-
-        {   'blur'        : "blur",
-            'trans'       : None,
-            'blur_fwhm'   : 2,
-            'steps'       : [2, 2, 2],
-            'tolerance'   : 0.0000001,
-            'simplex'     : 4,
-            'reverse'     : True # replace source and target 
-          }
-        ]
     }
 
 def linear_register(
@@ -273,6 +387,7 @@ def linear_register(
     work_dir=None,
     start=None,
     downsample=None,
+    blur_cache_dir=None,
     verbose=0
     ):
     """Perform linear registration, replacement for bestlinreg.pl script
@@ -304,6 +419,8 @@ def linear_register(
         work_dir - working directory (optional) , default create one in temp
         start - initial blurring level, default 16mm from configuration
         downsample - downsample initial files to this step size, default None
+        blur_cache_dir - persistent blur cache shared between runs (optional),
+            default taken from IPL_BLUR_CACHE environment variable
         verbose  - verbosity level
     Returns:
         resulting XFM file
@@ -341,6 +458,10 @@ def linear_register(
           if conf in linear_registration_config:
             conf = linear_registration_config[conf]
       
+      if isinstance(conf, list):
+          # accept legacy dict entries, normalize to StageCfg
+          conf = [c if isinstance(c, StageCfg) else StageCfg(**c) for c in conf]
+
       if parameters is None:
           parameters='-lsq9'
 
@@ -373,146 +494,224 @@ def linear_register(
 
         s_base=os.path.basename(sources[0]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
         t_base=os.path.basename(targets[0]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
+        if t_base==s_base:
+            # same basename from different directories: without this the
+            # source and target blur slots collide, and the concurrent
+            # blur pass would race two processes on one output file
+            t_base=t_base+'_trg'
+        st_prefix=s_base+'_'+t_base+'_'
 
         # figure out what to do here:
         with ipl.minc_tools.cache_files(work_dir=work_dir,context='reg') as tmp:
             
-            (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample)
-                
+            (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample, cache=tmp)
+
+            # native voxel size, queried lazily for the coarse-stage fast path
+            native_step = None
+
+            # filter the schedule once: stages skipped by start/close
+            # never enter the fit loop, and the active list tells the
+            # blur pass exactly which (blur,fwhm) pairs are needed
+            active = [(i,c) for (i,c) in enumerate(conf)
+                      if not (start is not None and start>c.blur_fwhm)
+                      and not (close and c.blur_fwhm>8)]
+
+            # prepare stage inputs up front: per-stage grids first, then
+            # each unique (input, blur, fwhm) signature is blurred exactly
+            # once and shared by every stage that needs it (bestlinreg_s
+            # repeats fwhm=8 twice); the blurs run in parallel since each
+            # one is an independent external process
+            stage_files={}
+            blur_jobs={}
+            for (i,c) in active:
+                stage_sources     = sources_lr
+                stage_targets     = targets_lr
+                stage_source_mask = source_mask_lr
+                stage_target_mask = target_mask_lr
+                if c.blur_fwhm>2:
+                    ds_stage = c.blur_fwhm/4.0
+                    if native_step is None:
+                        native_step = _min_step(sources_lr[0])
+                    if ds_stage > native_step*1.5 and (downsample is None or ds_stage > downsample):
+                        (stage_sources, stage_targets, stage_source_mask, stage_target_mask) = \
+                            minc.downsample_registration_files(sources_lr, targets_lr,
+                                source_mask_lr, target_mask_lr, ds_stage, cache=tmp,
+                                datatype='short')
+                stage_files[i]=(stage_sources, stage_targets, stage_source_mask, stage_target_mask)
+
+                if c.blur_fwhm>0:
+                    if native_step is None:
+                        native_step = _min_step(sources_lr[0])
+                    # kernel narrower than half a voxel is an identity
+                    if c.blur == 'blur' and c.blur_fwhm < 0.5*native_step:
+                        continue
+                    # low sigma: a small truncated FIR kernel is enough
+                    fast_blur_ = c.blur_fwhm <= 1.5*native_step
+                    for s_,_ in enumerate(stage_sources):
+                        blur_jobs[(stage_sources[s_], c.blur, c.blur_fwhm)] = \
+                            (s_base+'_'+c.blur+'_'+str(c.blur_fwhm)+'_'+str(s_)+'.mnc',
+                             c.blur=='dxyz', fast_blur_)
+                        blur_jobs[(stage_targets[s_], c.blur, c.blur_fwhm)] = \
+                            (t_base+'_'+c.blur+'_'+str(c.blur_fwhm)+'_'+str(s_)+'.mnc',
+                             c.blur=='dxyz', fast_blur_)
+
+            blurred={}
+            if blur_jobs:
+                import concurrent.futures
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=min(4, len(blur_jobs))) as executor:
+                    futures={k: executor.submit(_blur_cached, minc, tmp,
+                                k[0], v[0], v[1], k[2], k[1],
+                                cache_dir=blur_cache_dir, fast=v[2])
+                             for (k,v) in blur_jobs.items()}
+                    blurred={k: f.result() for (k,f) in futures.items()}
+
+            # per-stage solution cache: identical inputs plus an identical
+            # schedule prefix give the same minctracc solution, so cohort
+            # re-runs can skip whole stages (metadata hash only, cheap)
+            xfm_cache_dir = blur_cache_dir
+            if xfm_cache_dir is None:
+                xfm_cache_dir = os.environ.get('IPL_BLUR_CACHE')
+            stage_sig = None
+            if xfm_cache_dir is not None:
+                stage_sig = hashlib.sha1()
+                for f_ in sources+targets+[m_ for m_ in (init_xfm, source_mask, target_mask) if m_ is not None]:
+                    st_ = os.stat(f_)
+                    stage_sig.update('{}:{}:{}'.format(
+                        os.path.abspath(f_), st_.st_mtime_ns, st_.st_size).encode())
+                stage_sig.update(repr((parameters, objective, start, close,
+                                       norot, noshear, noshift, noscale,
+                                       downsample)).encode())
+
             # a fitting we shall go...
-            for (i,c) in enumerate(conf):
+            for (i,c) in active:
                 _parameters=parameters
                 
-                if 'parameters' in c and parameters!='-lsq6': # emulate Claude's approach
-                    _parameters=c.get('parameters')#'-lsq7'
+                if c.parameters is not None and parameters!='-lsq6': # emulate Claude's approach
+                    _parameters=c.parameters #'-lsq7'
                 
-                _reverse = c.get('reverse',False) # swap target and source 
+                _reverse = c.reverse # swap target and source 
                 # set up intermediate files
-                if start is not None and start>c['blur_fwhm']:
-                    continue
-                elif close and c['blur_fwhm']>8:
-                    continue
-                
-                tmp_xfm =    tmp.tmp(s_base+'_'+t_base+'_'+str(i)+'.xfm')
-
-                tmp_sources = sources_lr
-                tmp_targets = targets_lr
-
-                
-                if c['blur_fwhm']>0:
-                    tmp_sources=[]
-                    tmp_targets=[]
-                    
-                    for s_,_ in enumerate(sources_lr):
-                        tmp_source = tmp.cache(s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_source):
-                            minc.blur(sources_lr[s_],tmp_source,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                            
-                        tmp_target = tmp.cache(t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_target):
-                            minc.blur(targets_lr[s_],tmp_target,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                            
-                        tmp_sources.append(tmp_source)
-                        tmp_targets.append(tmp_target)
+                tmp_xfm =    tmp.tmp(st_prefix+str(i)+'.xfm')
+
+                cached_xfm = None
+                if stage_sig is not None:
+                    stage_sig.update(repr(tuple(c)).encode())
+                    cached_xfm = os.path.join(xfm_cache_dir, 'xfm',
+                                              stage_sig.hexdigest()[:16]+'.xfm')
+                    if os.path.exists(cached_xfm):
+                        shutil.copyfile(cached_xfm, tmp_xfm)
+                        prev_xfm = tmp_xfm
+                        continue
+
+                (stage_sources, stage_targets, stage_source_mask, stage_target_mask) = stage_files[i]
+
+                # blurred variants were precomputed above; stages below
+                # the blur threshold fall through to the unblurred grids
+                tmp_sources = [blurred.get((f, c.blur, c.blur_fwhm), f) for f in stage_sources]
+                tmp_targets = [blurred.get((f, c.blur, c.blur_fwhm), f) for f in stage_targets]
                 
                 objective_=objective
                 
                 if isinstance(objective, list):
                     objective_=objective[0]
-                    
+
+                # assemble the command line as a few slices joined once
                 if _reverse:
-                  args =[  'minctracc', 
-                              tmp_targets[0], tmp_sources[0],'-clobber', 
-                              _parameters , 
-                              objective_ ,
-                          '-simplex', c['simplex'],
-                          '-tol',     c['tolerance'] ]
-                  
-                  # additional modalities
-                  for s_ in range(len(tmp_targets)-1):
-                    if isinstance(objective, list):
-                        objective_=objective[s_+1]
-                    args.extend([ '-feature_vol',tmp_targets[s_+1],tmp_sources[s_+1],objective_.lstrip('-'),1.0])
+                    fit_src, fit_trg = tmp_targets, tmp_sources
                 else:
-                  # set up registration
-                  args =[  'minctracc', 
-                              tmp_sources[0], tmp_targets[0],'-clobber', 
-                              _parameters , 
-                              objective_ ,
-                          '-simplex', c['simplex'],
-                          '-tol',     c['tolerance'] ]
-                  
-                  for s_ in range(len(tmp_targets)-1):
+                    fit_src, fit_trg = tmp_sources, tmp_targets
+
+                head = ('minctracc',
+                        fit_src[0], fit_trg[0], '-clobber',
+                        _parameters,
+                        objective_,
+                        '-simplex', str(c.simplex),
+                        '-tol',     str(c.tolerance),
+                        '-step') + tuple(str(ii) for ii in c.steps)
+
+                # additional modalities
+                features = []
+                for s_ in range(len(tmp_targets)-1):
                     if isinstance(objective, list):
                         objective_=objective[s_+1]
-                    args.extend([ '-feature_vol',tmp_sources[s_+1],tmp_targets[s_+1],objective_.lstrip('-'),1.0])
-
-                args.append('-step')
-                args.extend(c['steps'])
+                    features.extend(('-feature_vol', fit_src[s_+1], fit_trg[s_+1],
+                                     objective_.lstrip('-'), '1.0'))
 
                 # Current transformation at this step
                 if prev_xfm is not None:
                     if _reverse :
-                      inv_prev_xfm =    tmp.tmp(s_base+'_'+t_base+'_'+str(i)+'_init.xfm')
-                      minc.xfminvert(prev_xfm,inv_prev_xfm)
-                      args.extend(['-transformation', inv_prev_xfm])
+                      inv_prev_xfm =    tmp.tmp(st_prefix+str(i)+'_init.xfm')
+                      if not _xfm_invert_py(prev_xfm,inv_prev_xfm):
+                          minc.xfminvert(prev_xfm,inv_prev_xfm)
+                      init_part = ('-transformation', inv_prev_xfm)
                     else:
-                      args.extend(['-transformation', prev_xfm])
+                      init_part = ('-transformation', prev_xfm)
                 elif init_xfm is not None:
                     # _reverse should not be first?
-                    args.extend(['-transformation', init_xfm, '-est_center'])
+                    init_part = ('-transformation', init_xfm, '-est_center')
                 elif close : 
-                    args.append('-identity')
+                    init_part = ('-identity',)
                 else:
                     # _reverse should not be first?
                     # Initial transformation will be computed from the from Principal axis 
                     # transformation (PAT).
-                    if c['trans'] is not None  and c['trans'][0] != '-est_translations':
-                        args.extend( c['trans'] )
+                    if c.trans is not None  and c.trans[0] != '-est_translations':
+                        init_part = tuple(c.trans)
                     else :
                         # will use manual transformation based on shif of CoM, should be identical to '-est_translations' , but it's not
-                        com_src=minc.stats(source,['-com','-world_only'],single_value=False)
-                        com_trg=minc.stats(target,['-com','-world_only'],single_value=False)
+                        com_src=_center_of_mass(minc, source)
+                        com_trg=_center_of_mass(minc, target)
                         diff=[com_trg[k]-com_src[k] for k in range(3)]
                         xfm=tmp.cache(s_base+'_init.xfm')
-                        minc.param2xfm(xfm, translation=diff)
-                        args.extend( ['-transformation',xfm] )
+                        _write_translation_xfm(xfm, diff)
+                        tmp.unlock(xfm)
+                        init_part = ('-transformation', xfm)
                 
                 # masks (even if the blurred image is masked, it's still preferable
                 # to use the mask in minctracc)
+                mask_part = ()
                 if _reverse :
                   if source_mask is not None:
-                      args.extend(['-model_mask', source_mask_lr])
+                      mask_part = ('-model_mask', stage_source_mask)
                   #disable one mask in this mode
-                  #if target_mask is not None:
-                      #args.extend(['-source_mask',  target_mask_lr])
                 else:
                   if source_mask is not None:
-                      args.extend(['-source_mask', source_mask_lr])
+                      mask_part += ('-source_mask', stage_source_mask)
                   if target_mask is not None:
-                      args.extend(['-model_mask',  target_mask_lr])
-                  
+                      mask_part += ('-model_mask',  stage_target_mask)
 
+                weight_part = ()
                 if noshear:
-                    args.extend( ['-w_shear',0,0,0] )
+                    weight_part += ('-w_shear','0','0','0')
                 if noscale:
-                    args.extend( ['-w_scales',0,0,0] )
+                    weight_part += ('-w_scales','0','0','0')
                 if noshift:
-                    args.extend( ['-w_translations',0,0,0] )
+                    weight_part += ('-w_translations','0','0','0')
                 if norot:
-                    args.extend( ['-w_rotations',0,0,0] )
+                    weight_part += ('-w_rotations','0','0','0')
 
                 # add files and run registration
-                args.append(tmp_xfm)
-                minc.command([str(ii) for ii in args],inputs=[tmp_source,tmp_target],outputs=[tmp_xfm])
+                args = [*head, *features, *init_part, *mask_part, *weight_part, tmp_xfm]
+                minc.command(args,inputs=[tmp_sources[0],tmp_targets[0]],outputs=[tmp_xfm])
                 
                 if _reverse:
-                      inv_tmp_xfm =    tmp.tmp(s_base+'_'+t_base+'_'+str(i)+'_sol.xfm')
-                      minc.xfminvert(tmp_xfm,inv_tmp_xfm)
+                      inv_tmp_xfm =    tmp.tmp(st_prefix+str(i)+'_sol.xfm')
+                      if not _xfm_invert_py(tmp_xfm,inv_tmp_xfm):
+                          minc.xfminvert(tmp_xfm,inv_tmp_xfm)
                       prev_xfm=inv_tmp_xfm
                 else:
                   prev_xfm = tmp_xfm
-                
+
+                if cached_xfm is not None:
+                    try:
+                        os.makedirs(os.path.dirname(cached_xfm))
+                    except OSError:
+                        pass
+                    # write-then-rename keeps concurrent runs safe
+                    shutil.copyfile(prev_xfm, cached_xfm+'.'+str(os.getpid()))
+                    os.replace(cached_xfm+'.'+str(os.getpid()), cached_xfm)
+
             shutil.copyfile(prev_xfm,output_xfm)
             return output_xfm
       
@@ -560,6 +759,62 @@ def linear_register_to_self(
 
 
 
+def _batch_worker_init():
+    """keep batch workers to one thread (and best-effort one core) each
+
+    minctracc and the itk tools are CPU bound; with one process per core
+    any internal threading only oversubscribes the host.
+    """
+    for v in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+              'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'):
+        os.environ[v] = '1'
+    if hasattr(os, 'sched_setaffinity'):
+        import multiprocessing
+        # pool workers are numbered 1..N; pids are not consecutive, so
+        # pinning by pid could stack several workers onto one core
+        identity = multiprocessing.current_process()._identity
+        if identity:
+            try:
+                cores = sorted(os.sched_getaffinity(0))
+                os.sched_setaffinity(0, {cores[(identity[0]-1) % len(cores)]})
+            except OSError:
+                pass
+
+
+def _run_linear_register(job):
+    """worker for linear_register_batch: job is a kwargs dict"""
+    return linear_register(**job)
+
+
+def linear_register_batch(jobs, n_jobs=None):
+    """run several independent linear registrations in parallel
+
+    Args:
+        jobs - list of kwargs dicts, each one a call to linear_register;
+               give each job its own work_dir (or a shared blur_cache_dir)
+               to reuse blurred volumes between runs
+        n_jobs - number of worker processes, default os.cpu_count()
+
+    Returns:
+        list of results in the order of jobs
+
+    Raises:
+        mincError when a registration fails
+    """
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    import concurrent.futures
+
+    # minctracc is single threaded and CPU bound, so independent pairs
+    # scale with cores; each worker process gets its own mincTools tempdir
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=n_jobs, initializer=_batch_worker_init) as executor:
+        futures = [executor.submit(_run_linear_register, j) for j in jobs]
+        # surface the first failure, but let the pool drain
+        return [f.result() for f in futures]
+
+
 def non_linear_register_full(
     source, target, output_xfm, 
     source_mask=None,
@@ -569,7 +824,8 @@ def non_linear_register_full(
     start=32,
     parameters=None,
     work_dir=None,
-    downsample=None
+    downsample=None,
+    blur_cache_dir=None
     ):
     """perform non-linear registration, multiple levels
     Args:
@@ -584,6 +840,8 @@ def non_linear_register_full(
         start - initial step size, default 32mm 
         level - final step size, default 4mm
         downsample - downsample initial files to this step size, default None
+        blur_cache_dir - persistent blur cache shared between runs (optional),
+            default taken from IPL_BLUR_CACHE environment variable
 
     Returns:
         resulting XFM file
@@ -681,14 +939,35 @@ def non_linear_register_full(
 
       s_base=os.path.basename(sources[0]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
       t_base=os.path.basename(targets[0]).rsplit('.gz',1)[0].rsplit('.mnc',1)[0]
+      if t_base==s_base:
+          # keep source and target blur slots apart (see linear_register)
+          t_base=t_base+'_trg'
+      st_prefix=s_base+'_'+t_base+'_'
 
       
       # figure out what to do here:
       with ipl.minc_tools.cache_files(work_dir=work_dir,context='reg') as tmp:
           # a fitting we shall go...
-          (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample)
-          
-          for (i,c) in enumerate(parameters['conf']):
+          (sources_lr, targets_lr, source_mask_lr, target_mask_lr)=minc.downsample_registration_files(sources, targets, source_mask, target_mask, downsample, cache=tmp)
+
+          # native voxel size, queried lazily for the coarse-stage fast path
+          native_step = None
+
+          # minctracc takes a single -step/-iterations per invocation, so
+          # the pyramid cannot be folded into one call; consecutive levels
+          # with identical fitting parameters can be, by summing their
+          # iteration counts (one fork/exec and one grid round-trip less)
+          conf_ = []
+          for c in parameters['conf']:
+              if conf_ and (c['step'], c['blur_fwhm'], c['blur']) == \
+                      (conf_[-1]['step'], conf_[-1]['blur_fwhm'], conf_[-1]['blur']):
+                  merged = dict(conf_[-1])
+                  merged['iterations'] = merged['iterations'] + c['iterations']
+                  conf_[-1] = merged
+              else:
+                  conf_.append(c)
+
+          for (i,c) in enumerate(conf_):
 
               if   c['step']>start:
                   continue
@@ -696,47 +975,87 @@ def non_linear_register_full(
                   break
 
               # set up intermediate files
-              tmp_=        tmp.tmp(s_base+'_'+t_base+'_'+str(i))
+              tmp_=        tmp.tmp(st_prefix+str(i))
               
               tmp_xfm =    tmp_+'.xfm'
               tmp_grid=    tmp_+'_grid_0.mnc'
 
-              tmp_sources=sources_lr
-              tmp_targets=targets_lr
+              # coarse pyramid levels run on a downsampled grid (~fwhm/4)
+              stage_sources     = sources_lr
+              stage_targets     = targets_lr
+              stage_source_mask = source_mask_lr
+              stage_target_mask = target_mask_lr
+              if c['blur_fwhm']>2:
+                    ds_stage = c['blur_fwhm']/4.0
+                    if native_step is None:
+                        native_step = _min_step(sources_lr[0])
+                    if ds_stage > native_step*1.5 and (downsample is None or ds_stage > downsample):
+                        (stage_sources, stage_targets, stage_source_mask, stage_target_mask) = \
+                            minc.downsample_registration_files(sources_lr, targets_lr,
+                                source_mask_lr, target_mask_lr, ds_stage, cache=tmp,
+                                datatype='short')
+
+              tmp_sources=stage_sources
+              tmp_targets=stage_targets
 
               if c['blur_fwhm']>0:
                     tmp_sources=[]
                     tmp_targets=[]
-                    
-                    for s_,_ in enumerate(sources_lr):
-                        tmp_source = tmp.cache(s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_source):
-                            minc.blur(sources_lr[s_],tmp_source,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                        tmp_target = tmp.cache(t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc')
-                        if not os.path.exists(tmp_target):
-                            minc.blur(targets_lr[s_],tmp_target,gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'])
-                        tmp_sources.append(tmp_source)
-                        tmp_targets.append(tmp_target)
+
+                    if native_step is None:
+                        native_step = _min_step(sources_lr[0])
+                    # low sigma: a small truncated FIR kernel is enough
+                    fast_blur_ = c['blur_fwhm'] <= 1.5*native_step
+                    # kernel narrower than half a voxel is an identity
+                    skip_blur_ = c['blur'] == 'blur' \
+                        and c['blur_fwhm'] < 0.5*native_step
+
+                    # source and target blurs are independent external
+                    # processes, run each pair concurrently
+                    import concurrent.futures
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                      for s_,_ in enumerate(stage_sources):
+                        if skip_blur_:
+                            tmp_sources.append(stage_sources[s_])
+                            tmp_targets.append(stage_targets[s_])
+                            continue
+                        f_src = executor.submit(_blur_cached, minc, tmp, stage_sources[s_],
+                                s_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc',
+                                gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'],
+                                blur=c['blur'], cache_dir=blur_cache_dir,
+                                fast=fast_blur_)
+                        if stage_targets[s_] == stage_sources[s_]:
+                            # same input file: share the result instead of
+                            # racing on the same cache slot
+                            f_trg = f_src
+                        else:
+                            f_trg = executor.submit(_blur_cached, minc, tmp, stage_targets[s_],
+                                t_base+'_'+c['blur']+'_'+str(c['blur_fwhm'])+'_'+str(s_)+'.mnc',
+                                gmag=(c['blur']=='dxyz'), fwhm=c['blur_fwhm'],
+                                blur=c['blur'], cache_dir=blur_cache_dir,
+                                fast=fast_blur_)
+                        tmp_sources.append(f_src.result())
+                        tmp_targets.append(f_trg.result())
 
 
               # set up registration
               args =['minctracc', tmp_sources[0],tmp_targets[0],'-clobber', 
                           '-nonlinear',  parameters['cost'],
-                          '-weight',     parameters['weight'],
-                          '-stiffness',  parameters['stiffness'],
-                          '-similarity', parameters['similarity'],
-                          '-sub_lattice',parameters['sub_lattice'],
+                          '-weight',     str(parameters['weight']),
+                          '-stiffness',  str(parameters['stiffness']),
+                          '-similarity', str(parameters['similarity']),
+                          '-sub_lattice',str(parameters['sub_lattice']),
                       ]
 
-              args.extend(['-iterations',     c['iterations'] ] )
-              args.extend(['-lattice_diam',   c['step']*3.0, c['step']*3.0, c['step']*3.0 ] )
-              args.extend(['-step',           c['step'],     c['step'],     c['step'] ] )
+              args.extend(['-iterations',     str(c['iterations']) ] )
+              args.extend(['-lattice_diam',  ] + [str(c['step']*3.0)]*3 )
+              args.extend(['-step',          ] + [str(c['step'])]*3 )
               
               if c['step']<4: #TODO: check if it's 4*minc_step ?
                   args.append('-no_super')
               
               for s_ in range(len(tmp_targets)-1):
-                  args.extend([ '-feature_vol',tmp_sources[s_+1],tmp_targets[s_+1],parameters['cost'],1.0])
+                  args.extend([ '-feature_vol',tmp_sources[s_+1],tmp_targets[s_+1],parameters['cost'],'1.0'])
               
                   # Current transformation at this step
               if prev_xfm is not None:
@@ -749,15 +1068,15 @@ def non_linear_register_full(
               # masks (even if the blurred image is masked, it's still preferable
               # to use the mask in minctracc)
               if source_mask is not None:
-                  args.extend(['-source_mask',source_mask_lr])
+                  args.extend(['-source_mask',stage_source_mask])
               if target_mask is not None:
-                  args.extend(['-model_mask',target_mask_lr])
+                  args.extend(['-model_mask',stage_target_mask])
 
               # add files and run registration
               args.append(tmp_xfm)
 
-              minc.command([str(ii) for ii in args],
-                              inputs=[tmp_source,tmp_target],
+              minc.command(args,
+                              inputs=[tmp_sources[0],tmp_targets[0]],
                               outputs=[tmp_xfm] )
 
               prev_xfm  = tmp_xfm
@@ -772,9 +1091,25 @@ def non_linear_register_full(
           # TODO: fix mincreshape too!
           minc.calc([prev_grid],'A[0]',tmp.tmp('final_grid_0.mnc'),datatype='-float')
           shutil.move(tmp.tmp('final_grid_0.mnc'),prev_grid)
-            
-          minc.param2xfm(tmp.tmp('identity.xfm'))
-          minc.xfmconcat([tmp.tmp('identity.xfm'),prev_xfm],output_xfm)
+
+          # concatenating with an identity only served to rewrite the xfm
+          # with a grid file named after the output; do the rename directly
+          # and keep the concat path for anything unexpected
+          out_grid = output_xfm.rsplit('.xfm',1)[0]+'_grid_0.mnc'
+          with open(prev_xfm) as f:
+              xfm_txt = f.read()
+          grid_ref = None
+          for cand in (os.path.basename(prev_grid), prev_grid):
+              if cand in xfm_txt:
+                  grid_ref = cand
+                  break
+          if grid_ref is not None and xfm_txt.count('Displacement_Volume') == 1:
+              shutil.copyfile(prev_grid, out_grid)
+              with open(output_xfm,'w') as f:
+                  f.write(xfm_txt.replace(grid_ref, os.path.basename(out_grid)))
+          else:
+              minc.param2xfm(tmp.tmp('identity.xfm'))
+              minc.xfmconcat([tmp.tmp('identity.xfm'),prev_xfm],output_xfm)
           return output_xfm
 
 def non_linear_register_increment(